@@ -1,114 +1,235 @@
+from abc import ABC, abstractmethod
 from dataclasses import dataclass
-from typing import Dict, Union
+from functools import partial
+from typing import Any, Callable, Dict, Optional, Tuple, Union
 import json
+import logging
+import selectors
 import socket
 import time
 
+logger = logging.getLogger(__name__)
+
 ENCODING = "utf-8"
 MAX_RESPONSE_SIZE = 1 << 10
 SOCKET_POLL_PERIOD = 1  # second
+HEATER_RETRY_DELAY_S = 0.1
+HEATER_RETRY_MAX_DELAY_S = 1
+
+try:
+    # orjson is considerably faster and works in bytes directly, but isn't packaged everywhere we run.
+    import orjson
+
+    def encode_json(value: Any) -> bytes:
+        return orjson.dumps(value)
+
+    def decode_json(raw: Union[bytes, memoryview]) -> Any:
+        return orjson.loads(raw)
+except ImportError:
+    # Match orjson's compact output rather than padding every separator with a space.
+    # Unlike `json.dumps`, which creates a new encoder whenever it's given options, this is only set up once.
+    json_encoder = json.JSONEncoder(separators=(",", ":"))
+
+    def encode_json(value: Any) -> bytes:
+        return json_encoder.encode(value).encode(ENCODING)
+
+    def decode_json(raw: Union[bytes, memoryview]) -> Any:
+        return json.loads(str(raw, ENCODING))
+
+# These commands never change, so only serialize them once.
+RESET_FILTER_WHEEL_REQUEST = encode_json({
+    "command": "reset_filter_wheel",
+    "args": {}
+})
+DISABLE_HEATER_REQUEST = encode_json({
+    "command": "disable_heater",
+    "args": {}
+})
 
 def boost_bool(value_raw: Union[str, bool]):
     """
     Boost.PropertyTree converts all values to strings, so we need to massage it into a bool.
     TODO: Remove this once we have Boost.JSON
     """
-    return value_raw if type(value_raw) == bool else value_raw == "true"
+    return value_raw is True or value_raw == "true"
+
+@dataclass(frozen=True)
+class HalCapabilities:
+    """What the HAL reports it can do, parsed once from its metadata."""
+    # Whether we can control the filter programmatically.
+    filter_control: bool = False
+    temperature_control: bool = False
+    focus_control: bool = False
+    # Whether we can override the exposure.
+    can_override_exposure: bool = False
+    # The camera's shutter time, if the HAL reports it.
+    max_led_flash_ms: Optional[int] = None
+
+    @classmethod
+    def from_metadata(cls, metadata: Dict) -> "HalCapabilities":
+        camera_options = metadata.get("camera_options")
+        return cls(
+            filter_control=boost_bool(metadata["filter_control"]),
+            temperature_control=boost_bool(metadata["temperature_control"]),
+            focus_control=boost_bool(metadata["focus_control"]),
+            can_override_exposure=boost_bool(metadata["can_override_exposure"]),
+            max_led_flash_ms=int(camera_options["shutter_time_ms"]) if camera_options else None
+        )
 
 class HalError(Exception):
     pass
 
-class IHal:
+def wait_readable(selector: selectors.BaseSelector, thread, deadline: float) -> bool:
+    """Wait for the socket registered with `selector` to be readable, or return False if `thread` is asked to stop first."""
+    isInterruptionRequested = thread.isInterruptionRequested
+    while True:
+        if isInterruptionRequested():
+            return False
+        if selector.select(SOCKET_POLL_PERIOD):
+            return True
+        if time.monotonic() >= deadline:
+            raise TimeoutError("HAL took too long to respond")
+
+class IHal(ABC):
+    @abstractmethod
     def run_command(self, command: Dict, thread=None, tries=float("inf")) -> Dict:
         raise NotImplementedError
     
+    @abstractmethod
     def disable_heater(self, thread, tries=5):
         raise NotImplementedError
     
+    @abstractmethod
     def reset_filter_wheel(self, thread):
         raise NotImplementedError
 
+# Shared by every `get_metadata` call. Callers must not modify it.
+MOCK_METADATA = {
+    "serial_number": "MOCK",
+    "hal_version": "MOCK",
+    "filter_control": True,
+    "temperature_control": True,
+    "can_override_exposure": True,
+    "focus_control": True
+}
+
+@dataclass
 class MockHal(IHal):
+    # Delay for every command other than `get_metadata`, so we can actually see what's going on in a mock run
+    delay_s: float = 1
+
     def run_command(self, command: Dict, thread=None, tries=float("inf")) -> Dict:
-        print("Mock HAL: run_command called with command")
-        print(command)
+        logger.info("Mock HAL: run_command called with %s", command["command"])
+        logger.debug("%s", command)
 
         if command["command"] == "get_metadata":
-            return {
-                "serial_number": "MOCK",
-                "hal_version": "MOCK",
-                "filter_control": True,
-                "temperature_control": True,
-                "can_override_exposure": True,
-                "focus_control": True
-            }
+            return MOCK_METADATA
         else:
-            # Delay so we can actually see what's going on in a mock run
-            time.sleep(1)
+            time.sleep(self.delay_s)
             return {}
 
     def disable_heater(self, thread, tries=5):
-        print("Mock HAL: disable_heater called")
+        logger.info("Mock HAL: disable_heater called")
     
     def reset_filter_wheel(self, thread):
-        print("Mock HAL: reset_filter_wheel called")
+        logger.info("Mock HAL: reset_filter_wheel called")
 
 @dataclass
 class Hal(IHal):
-    """Simple wrapper to send commands to the HAL."""
+    """
+    Simple wrapper to send commands to the HAL.
+    Not safe to use from more than one thread at a time, as every command shares one receive buffer.
+    Handing it from one thread to another between commands is fine.
+    """
     address: str
     port: int
 
+    def __post_init__(self):
+        # Responses are received into this rather than allocating for every command.
+        # It grows if a response doesn't fit.
+        self.receive_buffer = bytearray(MAX_RESPONSE_SIZE)
+        # Resolved on first use so that every command doesn't have to look up the address again.
+        self.socket_address: Optional[Tuple] = None
+
+    def connect(self) -> socket.socket:
+        if self.socket_address is None:
+            self.socket_address = socket.getaddrinfo(self.address, self.port, socket.AF_INET, socket.SOCK_STREAM)[0][4]
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            # Every exchange is a small request followed by a small response, so don't let Nagle or delayed ACKs hold them up.
+            s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if hasattr(socket, "TCP_QUICKACK"):
+                # Linux only
+                s.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+            s.connect(self.socket_address)
+        except:
+            s.close()
+            raise
+        return s
+
+    def receive_response(self, s: socket.socket, wait: Optional[Callable[[], bool]] = None) -> Any:
+        """
+        Receive a response into `receive_buffer` and decode it.
+        If given, `wait` is called before every read, and should block until there's something to read.
+        If it returns False, this gives up and returns None.
+        """
+        # Responses aren't delimited, so keep reading until we have a complete JSON object.
+        buffer = self.receive_buffer
+        recv_into = s.recv_into
+        received = 0
+        while True:
+            if received == len(buffer):
+                buffer.extend(bytes(len(buffer)))
+            if wait is not None and not wait():
+                return None
+            with memoryview(buffer) as view:
+                received_now = recv_into(view[received:])
+            if not received_now:
+                raise HalError("HAL closed the connection before sending a complete response")
+            received += received_now
+
+            with memoryview(buffer) as view:
+                try:
+                    return decode_json(view[:received])
+                except ValueError:
+                    pass
+
     def run_command(self, command: Dict, thread=None, tries=float("inf")) -> Dict:
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-            s.connect((self.address, self.port))
+        return self.run_request(encode_json(command), thread, tries)
 
-            request_raw = json.dumps(command).encode(ENCODING)
+    def run_request(self, request_raw: bytes, thread=None, tries=float("inf")) -> Dict:
+        """Like `run_command`, but for a command that has already been serialized."""
+        # Commands and responses aren't delimited, so each command gets a connection of its own.
+        with self.connect() as s:
             s.sendall(request_raw)
 
-            response_raw = bytes()
-
-            # If we're in a QThread, periodically check if we need to stop
-            # TODO: There's probably a better way to do this
-            if thread is not None:
-                try_count = 0
-                s.settimeout(SOCKET_POLL_PERIOD)
-                while not thread.isInterruptionRequested() and try_count < tries:
-                    try:
-                        response_raw = s.recv(MAX_RESPONSE_SIZE)
-                        break
-                    except socket.timeout:
-                        try_count += 1
-                        pass
-                else:
-                    if try_count >= tries:
-                        raise TimeoutError("HAL took too long to respond")
-                    else:
-                        return {}
+            if thread is None:
+                response = self.receive_response(s)
             else:
-                response_raw = s.recv(MAX_RESPONSE_SIZE)
-            response = json.loads(response_raw.decode(ENCODING))
+                # If we're in a QThread, periodically check if we need to stop while waiting for each part of the response
+                deadline = time.monotonic() + tries * SOCKET_POLL_PERIOD
+                with selectors.DefaultSelector() as selector:
+                    selector.register(s, selectors.EVENT_READ)
+                    response = self.receive_response(s, partial(wait_readable, selector, thread, deadline))
+                if response is None:
+                    return {}
             if not boost_bool(response["success"]):
                 raise HalError(response["error_message"])
 
             return response["response"]
 
     def reset_filter_wheel(self, thread):
-        self.run_command({
-            "command": "reset_filter_wheel",
-            "args": {}
-        }, thread)
+        self.run_request(RESET_FILTER_WHEEL_REQUEST, thread)
 
     def disable_heater(self, thread, tries=5):
-        for _ in range(tries):
+        for try_index in range(tries):
             try:
-                self.run_command({
-                    "command": "disable_heater",
-                    "args": {}
-                }, thread, tries=1)
+                self.run_request(DISABLE_HEATER_REQUEST, thread, tries=1)
                 break
-            except Exception as e:
-                print(e)
-                time.sleep(1)
+            except (OSError, ValueError, KeyError, HalError) as e:
+                logger.warning("Failed to disable the heater: %s", e)
+                # Back off between tries, starting short so a quick recovery doesn't leave the heater on for longer than needed.
+                if try_index < tries - 1:
+                    time.sleep(min(HEATER_RETRY_DELAY_S * 2 ** try_index, HEATER_RETRY_MAX_DELAY_S))
         else:
             raise HalError(f"lp0 on fire: failed to turn off the heater after {tries} tries. RESTART SYSTEM.")
@@ -1,9 +1,45 @@
+import logging
 import socket
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
 
 # TODO: Make this configurable
 CONNECT_ADDRESS = "127.0.0.1"
 LISTEN_ADDRESS = "0.0.0.0"
 
-def exists(address, port: int):
+# Don't hang for the system's default connect timeout (which can be minutes) if the address isn't responding.
+EXISTS_TIMEOUT_S = 0.5
+# The same servers get probed several times in quick succession during startup.
+EXISTS_CACHE_DURATION_S = 5
+
+# (address, port) -> (expiry time, result)
+exists_cache: Dict[Tuple[str, int], Tuple[float, bool]] = {}
+
+def exists(address, port: int, timeout: Optional[float] = EXISTS_TIMEOUT_S):
+    """
+    Whether something is listening on `port`.
+    Pass `timeout=None` to wait as long as the system allows, where a slow server mustn't be mistaken for a missing one.
+    """
+    key = (address, port)
+    now = time.monotonic()
+    cached = exists_cache.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
-        return s.connect_ex((address, port)) == 0
+        s.settimeout(timeout)
+        try:
+            s.connect((address, port))
+            result = True
+        except socket.timeout:
+            # Something may well be there, just slow, so don't cache this.
+            logger.warning("Timed out after %s s connecting to %s:%d, treating it as absent", timeout, address, port)
+            return False
+        except OSError:
+            # Includes refused connections and failures to resolve the address
+            result = False
+
+    exists_cache[key] = (now + EXISTS_CACHE_DURATION_S, result)
+    return result
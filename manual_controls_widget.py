@@ -1,24 +1,30 @@
 import json
-import time
+import logging
+from dataclasses import dataclass
 from enum import Enum
 from functools import partial
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
 
-from PySide2.QtCore import Slot, QThread, Qt
-from PySide2.QtGui import QDoubleValidator, QIntValidator
-from PySide2.QtWidgets import QCheckBox, QComboBox, QErrorMessage, QGridLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QSlider, QSizePolicy, QVBoxLayout, QWidget
+from PySide2.QtCore import QCoreApplication, QObject, Signal, Slot, QThread, Qt
+from PySide2.QtGui import QDoubleValidator
+from PySide2.QtWidgets import QAbstractSpinBox, QCheckBox, QComboBox, QErrorMessage, QGridLayout, QHBoxLayout, QLabel, QLineEdit, QPushButton, QSlider, QSizePolicy, QSpinBox, QVBoxLayout, QWidget
 
 import ip_utils
-from hal import boost_bool, Hal, MockHal
+from hal import Hal, HalCapabilities, IHal, MockHal
 from sequencing_protocol import MAX_TEMPERATURE_HOLD_S, MAX_TEMPERATURE_WAIT_S
 
+logger = logging.getLogger(__name__)
+
 WINDOW_TITLE = "454 Image Preview"
 HAL_PORT = 45400
 HAL_ADJUSTMENTS_PORT = 45404
 MANUAL_OUTPUT_DIR = Path.home() / "454" / "output" / "manual"
 MOCK_WARNING_TEXT = f"No HAL on port {HAL_PORT}, running in mock mode"
-JSON_FILENAME_MAPPING = {
+# Used until the HAL reports the camera's shutter time.
+DEFAULT_MAX_LED_FLASH_MS = 5000
+LED_COLORS = ("red", "orange", "green", "blue")
+JSON_FILENAME_TRANSLATION = str.maketrans({
     "{": "(",
     "}": ")",
     "[": "(",
@@ -26,6 +32,12 @@ JSON_FILENAME_MAPPING = {
     ":": "",
     "\"": "",
     "'": ""
+})
+
+# Shared by the capture and live preview commands; `flash()` adds the images.
+PREVIEW_SEQUENCE_TEMPLATE = {
+    "label": "Preview sequence",
+    "schema_version": 0
 }
 
 class FlashMode(Enum):
@@ -33,264 +45,313 @@ class FlashMode(Enum):
     CAPTURE_ONE = 1
     LIVE_PREVIEW = 2
 
-class HalThread(QThread):
+class HalWorker(QObject):
+    """
+    Runs HAL commands on whichever thread it's moved to.
+    Call `runCommand` from the GUI thread to start a command.
+    """
+    commandRequested = Signal(dict)
+    busyChanged = Signal(bool)
+    # Error dialogs have to be shown from the GUI thread, so errors are handed back there.
+    error = Signal(str)
+
     def __init__(self, halAddress, port):
         super().__init__()
-        self.command: Optional[Dict] = None
+        self.interruptionRequested = False
+        # Set as soon as a command is requested rather than when it starts, so a second click can't sneak in behind it.
+        self.busy = False
+        self.halAddress = halAddress
+        self.port = port
+        # Created by `connectToHal` once the worker is on its own thread.
+        self.hal: Optional[IHal] = None
+
+        # Queued so that commands run on the worker's thread, not the emitter's.
+        self.commandRequested.connect(self.run, Qt.QueuedConnection)
+
+    def runCommand(self, command: Dict) -> bool:
+        """Start `command` unless one is already running. Returns whether it was started."""
+        if self.busy:
+            # Commands aren't queued behind each other: most are started by a button that's about to be re-enabled anyway,
+            # and a live preview runs until it's cancelled, so one queued behind it would start as soon as it was stopped.
+            logger.info("Command is still running, not running %s", command["command"])
+            return False
+
+        self.busy = True
+        self.commandRequested.emit(command)
+        return True
+
+    # The worker's thread lives on between commands, so it keeps its own interruption flag rather than using QThread's.
+    # `Hal.run_command` only needs `isInterruptionRequested` from the thread it's given.
+    @Slot(None)
+    def requestInterruption(self):
+        self.interruptionRequested = True
+
+    def isInterruptionRequested(self) -> bool:
+        return self.interruptionRequested
 
+    @Slot(None)
+    def connectToHal(self):
         # Create the HAL iff there's a socket we can connect to.
         # Otherwise, run in mock mode.
-        if ip_utils.exists(halAddress, port):
-            self.hal = Hal(halAddress, port)
+        # This is done on the worker's thread, so it can wait as long as it takes for a slow HAL rather than mistaking it for a missing one.
+        if ip_utils.exists(self.halAddress, self.port, timeout=None):
+            self.hal = Hal(self.halAddress, self.port)
         else:
             self.hal = MockHal()
 
-    def runCommand(self, command: Dict):
-        if self.isRunning():
-            raise Exception("Command is still running")
+    @Slot(dict)
+    def run(self, command: Dict):
+        self.interruptionRequested = False
+        self.busyChanged.emit(True)
 
-        self.command = command
-        self.start()
-
-    @Slot(None)
-    def run(self):
-        command = self.command
-        if command is None:
-            raise Exception("run called without a command")
-
-        self.command = None
-
-        print(command)
-
-        if self.hal is None:
-            print("Mock mode, not running the command")
-            time.sleep(1)
-            return
+        logger.info("Running manual command %s", command["command"])
+        logger.debug("%s", command)
 
         try:
             self.hal.run_command(command, self)
         except Exception as e:
             errorString = f"HAL error: {str(e)}"
-            print(errorString)
-            QErrorMessage.qtHandler().showMessage(errorString)
+            logger.error(errorString)
+            self.error.emit(errorString)
+        finally:
+            self.busy = False
+            self.busyChanged.emit(False)
+
+def filter_name(pickerText: str) -> str:
+    """Convert the filter picker's text (e.g. "No filter") into the HAL's name for it (e.g. "no_filter")."""
+    return pickerText.lower().replace(" ", "_")
+
+@dataclass
+class SliderRow:
+    """A labeled slider, the number input that mirrors it, and optionally a checkbox to enable them."""
+    label: QLabel
+    slider: QSlider
+    number: QSpinBox
+    unit: QLabel
+    checkbox: Optional[QCheckBox]
+
+    def widgets(self) -> List[QWidget]:
+        """All of the widgets in layout order, with the checkbox (if any) last."""
+        widgets: List[QWidget] = [self.label, self.slider, self.number, self.unit]
+        if self.checkbox is not None:
+            widgets.append(self.checkbox)
+        return widgets
+
+def make_labeled_slider_controls(labelText: str, unitText: str, valueMax: int, defaultValue: int = 0, checkbox: bool = True) -> SliderRow:
+    # TODO: Make some part of this the corresponding color
+    sliderWidget = QSlider(Qt.Horizontal)
+    sliderWidget.setRange(0, valueMax)
+    sliderWidget.setValue(defaultValue)
+
+    numberWidget = QSpinBox()
+    numberWidget.setMaximumWidth(50)
+    # Look like a plain text field, as the slider already does the stepping.
+    numberWidget.setButtonSymbols(QAbstractSpinBox.NoButtons)
+    numberWidget.setAlignment(Qt.AlignRight)
+    numberWidget.setRange(0, valueMax)
+    numberWidget.setValue(defaultValue)
+
+    # Both of these are C++ slots, so keeping the pair in sync never goes through Python.
+    # Each only emits when its value actually changes, which stops the echo.
+    numberWidget.valueChanged[int].connect(sliderWidget.setValue)
+    sliderWidget.valueChanged.connect(numberWidget.setValue)
+    # Follow the slider's range, which `setHalMetadata` raises to the camera's shutter time.
+    sliderWidget.rangeChanged.connect(numberWidget.setRange)
+
+    enableCheckbox: Optional[QCheckBox] = None
+    if checkbox:
+        # Start out unchecked, with the controls disabled to match.
+        enableCheckbox = QCheckBox()
+        enableCheckbox.toggled.connect(numberWidget.setEnabled)
+        enableCheckbox.toggled.connect(sliderWidget.setEnabled)
+        numberWidget.setEnabled(False)
+        sliderWidget.setEnabled(False)
+
+    return SliderRow(QLabel(labelText), sliderWidget, numberWidget, QLabel(unitText), enableCheckbox)
+
+def track_value(values: Dict, key: str, widget: QWidget):
+    """Mirror a control's value into `values` so that it can be read without going back to the widget."""
+    if isinstance(widget, QSlider):
+        values[key] = widget.value()
+        widget.valueChanged.connect(partial(values.__setitem__, key))
+    elif isinstance(widget, QCheckBox):
+        values[key] = widget.isChecked()
+        widget.toggled.connect(partial(values.__setitem__, key))
 
 class ManualControlsWidget(QWidget):
-    def __init__(self, halAddress, halMetadata):
+    # Connected to each button's setEnabled, so toggling them all is a single emit.
+    startButtonsEnabledChanged = Signal(bool)
+    adjustmentsButtonsEnabledChanged = Signal(bool)
+
+    def __init__(self, halAddress):
         super().__init__()
 
-        self.halThread = HalThread(halAddress, HAL_PORT)
-        self.halAdjustmentsThread = HalThread(halAddress, HAL_ADJUSTMENTS_PORT)
-
-        # Whether we can control the filter programmatically.
-        filterControl = False
-        # Whether we have temperature control.
-        temperatureControl = False
-        # Whether we can override the exposure.
-        canOverrideExposure = False
-        maxLedFlashMs = 5000
-
-        filterControl = boost_bool(halMetadata["filter_control"])
-        temperatureControl = boost_bool(halMetadata["temperature_control"])
-        focusControl = boost_bool(halMetadata["focus_control"])
-        canOverrideExposure = boost_bool(halMetadata["can_override_exposure"])
-        cameraOptions = halMetadata.get("camera_options")
-        if cameraOptions:
-            maxLedFlashMs = int(cameraOptions["shutter_time_ms"])
+        # Each worker gets a thread for the lifetime of the widget rather than a new thread per command.
+        self.halWorker = HalWorker(halAddress, HAL_PORT)
+        self.halThread = QThread(self)
+        self.halWorker.moveToThread(self.halThread)
+        self.halAdjustmentsWorker = HalWorker(halAddress, HAL_ADJUSTMENTS_PORT)
+        self.halAdjustmentsThread = QThread(self)
+        self.halAdjustmentsWorker.moveToThread(self.halAdjustmentsThread)
+
+        # What the HAL supports isn't known until its metadata arrives (see `setHalMetadata`).
+        # Until then, the optional controls are hidden.
+        self.halCapabilities = HalCapabilities()
+        maxLedFlashMs = DEFAULT_MAX_LED_FLASH_MS
 
         # Make sure we have somewhere to save manually-captured images
         MANUAL_OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
+        # As sent with each capture.
+        self.manualOutputDir = str(MANUAL_OUTPUT_DIR)
 
         self.startButtons: List[QPushButton] = []
         self.stopButton = QPushButton("Cancel manual operation")
-        self.stopButton.clicked.connect(self.halThread.requestInterruption)
+        # Direct, since a queued call wouldn't reach the worker until the command it's meant to stop has finished.
+        self.stopButton.clicked.connect(self.halWorker.requestInterruption, Qt.DirectConnection)
 
         self.adjustmentsButtons: List[QPushButton] = []
 
-        # Generate the controls for each LED.
-        # This cannot be rolled into the `for` loop below because Python's late-binding will result in the connections being crossed.
-        def make_labeled_slider_controls(labelText: str, unitText: str, valueMax: int, defaultValue: int = 0, checkbox: bool = True) -> List[QWidget]:
-            # TODO: Make some part of this the corresponding color
-            widgets: List[QWidget] = []
-            widgets.append(QLabel(labelText))
-
-            sliderWidget = QSlider(Qt.Horizontal)
-            widgets.append(sliderWidget)
-            sliderWidget.setRange(0, valueMax)
-
-            numberWidget = QLineEdit()
-            widgets.append(numberWidget)
-            numberWidget.setMaximumWidth(50)
-            numberWidget.setValidator(QIntValidator())
-            numberWidget.setAlignment(Qt.AlignRight)
-            numberWidget.setText(str(defaultValue))
-            sliderWidget.setSliderPosition(defaultValue)
-
-            widgets.append(QLabel(unitText))
-
-            numberWidget.textChanged.connect(lambda x: sliderWidget.setValue(int(x)))
-            sliderWidget.sliderMoved.connect(lambda x: numberWidget.setText(str(x)))
-
-            if checkbox:
-                enableCheckbox = QCheckBox()
-                def enable_disable_widgets(enable: bool):
-                    numberWidget.setEnabled(enable)
-                    sliderWidget.setEnabled(enable)
-                enableCheckbox.stateChanged.connect(lambda x: enable_disable_widgets(x == Qt.Checked))
-                enableCheckbox.stateChanged.emit(Qt.Unchecked)
-                widgets.append(enableCheckbox)
-
-            return widgets
+        # Owned by the widget rather than the input, in case more inputs come to share it.
+        self.doubleValidator = QDoubleValidator(self)
 
         # LED controls.
         ledControlsLayout = QGridLayout()
-        self.durationNumbers: Dict[str, QLineEdit] = {}
-        self.durationCheckboxes: Dict[str, QCheckBox] = {}
-        self.pwmNumbers: Dict[str, QLineEdit] = {}
-        for colorIndex, colorName in enumerate(["red", "orange", "green", "blue"]):
-            widgetIndex = 0
-            checkbox: Optional[QCheckBox] = None
-            for widget in make_labeled_slider_controls(colorName.capitalize(), "ms", maxLedFlashMs):
-                if isinstance(widget, QLineEdit):
-                    # Hold on to the text inputs so we can retrieve their values on `flash()`.
-                    # TODO: Will need a different way of doing this if there is ever another QLineEdit here
-                    self.durationNumbers[colorName] = widget
-                    ledControlsLayout.addWidget(widget, colorIndex, widgetIndex)
-                    widgetIndex += 1
-                elif isinstance(widget, QCheckBox):
-                    self.durationCheckboxes[colorName] = widget
-                    # HACK: Put this one at the end
-                    checkbox = widget
-                else:
-                    ledControlsLayout.addWidget(widget, colorIndex, widgetIndex)
-                    widgetIndex += 1
+        self.durationValues: Dict[str, int] = {}
+        self.durationEnabled: Dict[str, bool] = {}
+        self.pwmValues: Dict[str, int] = {}
+        self.durationSliders: List[QSlider] = []
+        # Repeated flashes and previews usually have the same settings, so reuse what was sent last time until they change.
+        self.cachedFlashes: Optional[List[Dict]] = None
+        self.cachedFlashesOverride: Optional[int] = None
+        # Flashes, filter, and the capture label made from them.
+        self.cachedLabelDetails: Optional[Tuple[List[Dict], str, str]] = None
+        for colorIndex, colorName in enumerate(LED_COLORS):
+            durationRow = make_labeled_slider_controls(colorName.capitalize(), "ms", maxLedFlashMs)
+            track_value(self.durationValues, colorName, durationRow.slider)
+            track_value(self.durationEnabled, colorName, durationRow.checkbox)
+            self.durationSliders.append(durationRow.slider)
             # TODO: These should be toggled by the checkbox
-            for widget in make_labeled_slider_controls("", "‰", valueMax=1000, defaultValue=1000, checkbox=False):
-                if isinstance(widget, QLineEdit):
-                    # Hold on to the text inputs so we can retrieve their values on `flash()`.
-                    # TODO: Will need a different way of doing this if there is ever another QLineEdit here
-                    self.pwmNumbers[colorName] = widget
-                ledControlsLayout.addWidget(widget, colorIndex, widgetIndex)
-                widgetIndex += 1
-            # HACK: Now add the checkbox so it's all the way at the right
-            ledControlsLayout.addWidget(checkbox, colorIndex, widgetIndex)
+            pwmRow = make_labeled_slider_controls("", "‰", valueMax=1000, defaultValue=1000, checkbox=False)
+            track_value(self.pwmValues, colorName, pwmRow.slider)
+            durationRow.slider.valueChanged.connect(self.invalidateFlashes)
+            durationRow.checkbox.toggled.connect(self.invalidateFlashes)
+            pwmRow.slider.valueChanged.connect(self.invalidateFlashes)
+
+            # Duration, then PWM, then the checkbox all the way at the right.
+            for column, widget in enumerate((durationRow.label, durationRow.slider, durationRow.number, durationRow.unit, pwmRow.label, pwmRow.slider, pwmRow.number, pwmRow.unit, durationRow.checkbox)):
+                ledControlsLayout.addWidget(widget, colorIndex, column)
         ledControlsWidget = QWidget()
         ledControlsWidget.setLayout(ledControlsLayout)
 
-        overrideExposureWidget: Optional[QWidget] = None
-        self.overrideExposureNumber: Optional[QLineEdit] = None
-        self.overrideExposureCheckbox: Optional[QCheckBox] = None
-        if canOverrideExposure:
-            overrideExposureLayout = QHBoxLayout()
-            for widget in make_labeled_slider_controls("Capture exposure time override", "ms", valueMax=maxLedFlashMs, defaultValue=maxLedFlashMs, checkbox=True):
-                if isinstance(widget, QLineEdit):
-                    self.overrideExposureNumber = widget
-                elif isinstance(widget, QCheckBox):
-                    self.overrideExposureCheckbox = widget
-                overrideExposureLayout.addWidget(widget)
-            overrideExposureWidget = QWidget()
-            overrideExposureWidget.setLayout(overrideExposureLayout)
+        overrideExposureLayout = QHBoxLayout()
+        overrideExposureRow = make_labeled_slider_controls("Capture exposure time override", "ms", valueMax=maxLedFlashMs, defaultValue=maxLedFlashMs, checkbox=True)
+        self.overrideExposureSlider = overrideExposureRow.slider
+        # Exposure time overrides by flash mode, mirrored from their controls.
+        # Live preview always uses its override (if the HAL supports it); capture only if it's checked.
+        self.exposureOverrides: Dict[FlashMode, int] = {}
+        self.exposureOverrideEnabled: Dict[FlashMode, bool] = {FlashMode.LIVE_PREVIEW: True}
+        track_value(self.exposureOverrides, FlashMode.CAPTURE_ONE, overrideExposureRow.slider)
+        track_value(self.exposureOverrideEnabled, FlashMode.CAPTURE_ONE, overrideExposureRow.checkbox)
+        for widget in overrideExposureRow.widgets():
+            overrideExposureLayout.addWidget(widget)
+        self.overrideExposureWidget = QWidget()
+        self.overrideExposureWidget.setLayout(overrideExposureLayout)
+        self.overrideExposureWidget.setVisible(False)
 
         # Filter picker.
         filterLabel = QLabel("Filter")
         filterLabel.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-        self.filterPicker: Optional[QComboBox] = None
-        filterResetButton: Optional[QPushButton] = None
-        if filterControl:
-            self.filterPicker = QComboBox()
-            self.filterPicker.addItems(["Any filter", "No filter", "Red", "Orange", "Green", "Blue"])
-            self.filterPicker.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-            filterResetButton = QPushButton("Reset")
-            filterResetButton.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
-            filterResetButton.clicked.connect(self.resetFilterWheel)
+        self.filterPicker = QComboBox()
+        self.filterPicker.addItems(["Any filter", "No filter", "Red", "Orange", "Green", "Blue"])
+        self.filterPicker.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        # The filter as the HAL names it, kept up to date so `flash()` doesn't have to convert it every time.
+        self.filterName = filter_name(self.filterPicker.currentText())
+        self.filterPicker.currentTextChanged.connect(self.filterChanged)
+        filterResetButton = QPushButton("Reset")
+        filterResetButton.setSizePolicy(QSizePolicy.Fixed, QSizePolicy.Fixed)
+        filterResetButton.clicked.connect(self.resetFilterWheel)
+        self.filterWidgets: List[QWidget] = [filterLabel, self.filterPicker, filterResetButton]
 
         flashButton = QPushButton("Flash")
-        flashButton.clicked.connect(partial(self.flash, FlashMode.FLASH_ONLY))
+        flashButton.clicked.connect(self.flashOnly)
         captureNowButton = QPushButton("Capture")
-        captureNowButton.clicked.connect(partial(self.flash, FlashMode.CAPTURE_ONE))
+        captureNowButton.clicked.connect(self.captureOne)
         self.startButtons.append(flashButton)
         self.startButtons.append(captureNowButton)
         ledStartButtonsLayout = QHBoxLayout()
         ledStartButtonsLayout.addWidget(flashButton)
         ledStartButtonsLayout.addWidget(captureNowButton)
-        if self.filterPicker:
-            ledStartButtonsLayout.addWidget(filterLabel)
-            ledStartButtonsLayout.addWidget(self.filterPicker)
-            ledStartButtonsLayout.addWidget(filterResetButton)
-            self.startButtons.append(filterResetButton)
+        for widget in self.filterWidgets:
+            widget.setVisible(False)
+            ledStartButtonsLayout.addWidget(widget)
+        self.startButtons.append(filterResetButton)
         ledStartButtonsWidget = QWidget()
         ledStartButtonsWidget.setLayout(ledStartButtonsLayout)
 
         # Live preview controls.
         livePreviewLayout = QHBoxLayout()
-        self.livePreviewNumber: Optional[QLineEdit] = None
-        if canOverrideExposure:
-            for widget in make_labeled_slider_controls("Live preview exposure time", "ms", valueMax=1000, defaultValue=1000, checkbox=False):
-                if isinstance(widget, QLineEdit):
-                    # Hold on to the text input so we can retrieve its value on `flash()`.
-                    # TODO: Will need a different way of doing this if there is ever another QLineEdit here
-                    self.livePreviewNumber = widget
-                livePreviewLayout.addWidget(widget)
+        livePreviewExposureRow = make_labeled_slider_controls("Live preview exposure time", "ms", valueMax=1000, defaultValue=1000, checkbox=False)
+        track_value(self.exposureOverrides, FlashMode.LIVE_PREVIEW, livePreviewExposureRow.slider)
+        self.livePreviewExposureWidgets = livePreviewExposureRow.widgets()
+        for widget in self.livePreviewExposureWidgets:
+            widget.setVisible(False)
+            livePreviewLayout.addWidget(widget)
         startLivePreviewButton = QPushButton("Start live preview")
-        startLivePreviewButton.clicked.connect(partial(self.flash, FlashMode.LIVE_PREVIEW))
+        startLivePreviewButton.clicked.connect(self.startLivePreview)
         livePreviewLayout.addWidget(startLivePreviewButton)
         self.startButtons.append(startLivePreviewButton)
         livePreviewWidget = QWidget()
         livePreviewWidget.setLayout(livePreviewLayout)
 
         # Focus controls.
-        focusControlsWidget: Optional[QWidget] = None
-        if focusControl:
-            def make_focus_nudge_button(steps: int) -> QPushButton:
-                text = ("+" if steps > 0 else "") + str(steps)
-                button = QPushButton(text)
-                button.clicked.connect(partial(self.nudgeBaseFocus, steps))
-                self.adjustmentsButtons.append(button)
-                return button
-
-            focusControlsLayout = QHBoxLayout()
-            focusControlsLayout.addWidget(QLabel("Focus"))
-            focusControlsLayout.addWidget(make_focus_nudge_button(-1000))
-            focusControlsLayout.addWidget(make_focus_nudge_button(-500))
-            focusControlsLayout.addWidget(make_focus_nudge_button(-100))
-            focusControlsLayout.addWidget(make_focus_nudge_button(100))
-            focusControlsLayout.addWidget(make_focus_nudge_button(500))
-            focusControlsLayout.addWidget(make_focus_nudge_button(1000))
-            focusControlsWidget = QWidget()
-            focusControlsWidget.setLayout(focusControlsLayout)
+        def make_focus_nudge_button(steps: int) -> QPushButton:
+            button = QPushButton(f"{steps:+d}")
+            button.setProperty("steps", steps)
+            button.clicked.connect(self.focusNudgeButtonClicked)
+            self.adjustmentsButtons.append(button)
+            return button
+
+        focusControlsLayout = QHBoxLayout()
+        focusControlsLayout.addWidget(QLabel("Focus"))
+        focusControlsLayout.addWidget(make_focus_nudge_button(-1000))
+        focusControlsLayout.addWidget(make_focus_nudge_button(-500))
+        focusControlsLayout.addWidget(make_focus_nudge_button(-100))
+        focusControlsLayout.addWidget(make_focus_nudge_button(100))
+        focusControlsLayout.addWidget(make_focus_nudge_button(500))
+        focusControlsLayout.addWidget(make_focus_nudge_button(1000))
+        self.focusControlsWidget = QWidget()
+        self.focusControlsWidget.setLayout(focusControlsLayout)
+        self.focusControlsWidget.setVisible(False)
 
         # Temperature controls.
-        temperatureControlsWidget: Optional[QWidget] = None
-        if temperatureControl:
-            self.temperatureNumber = QLineEdit()
-            self.temperatureNumber.setMaximumWidth(50)
-            self.temperatureNumber.setValidator(QDoubleValidator())
-            self.temperatureNumber.setAlignment(Qt.AlignRight)
-            heaterOnButton = QPushButton("Set")
-            heaterOnButton.clicked.connect(self.setTemperature)
-            heaterOffButton = QPushButton("Disable")
-            heaterOffButton.clicked.connect(self.disableHeater)
-            self.startButtons.append(heaterOnButton)
-            self.startButtons.append(heaterOffButton)
-            temperatureControlsLayout = QHBoxLayout()
-            temperatureControlsLayout.addWidget(QLabel("Heater"))
-            temperatureControlsLayout.addWidget(self.temperatureNumber)
-            temperatureControlsLayout.addWidget(QLabel("ºC"))
-            temperatureControlsLayout.addWidget(heaterOnButton)
-            temperatureControlsLayout.addWidget(heaterOffButton)
-            temperatureControlsWidget = QWidget()
-            temperatureControlsWidget.setLayout(temperatureControlsLayout)
+        self.temperatureNumber = QLineEdit()
+        self.temperatureNumber.setMaximumWidth(50)
+        self.temperatureNumber.setValidator(self.doubleValidator)
+        self.temperatureNumber.setAlignment(Qt.AlignRight)
+        heaterOnButton = QPushButton("Set")
+        heaterOnButton.clicked.connect(self.setTemperature)
+        heaterOffButton = QPushButton("Disable")
+        heaterOffButton.clicked.connect(self.disableHeater)
+        self.startButtons.append(heaterOnButton)
+        self.startButtons.append(heaterOffButton)
+        temperatureControlsLayout = QHBoxLayout()
+        temperatureControlsLayout.addWidget(QLabel("Heater"))
+        temperatureControlsLayout.addWidget(self.temperatureNumber)
+        temperatureControlsLayout.addWidget(QLabel("ºC"))
+        temperatureControlsLayout.addWidget(heaterOnButton)
+        temperatureControlsLayout.addWidget(heaterOffButton)
+        self.temperatureControlsWidget = QWidget()
+        self.temperatureControlsWidget.setLayout(temperatureControlsLayout)
+        self.temperatureControlsWidget.setVisible(False)
 
         # UV cleaving controls.
         uvCleavingControlsLayout = QHBoxLayout()
-        for widget in make_labeled_slider_controls("UV", "ms", valueMax=5000, checkbox=False):
-            if isinstance(widget, QLineEdit):
-                # Hold on to the text input so we can retrieve their values on `cleave()`.
-                # TODO: Will need a different way of doing this if there is ever another QLineEdit here
-                self.cleavingDurationNumber: QLineEdit = widget
-            uvCleavingControlsLayout.addWidget(widget)
-        for widget in make_labeled_slider_controls("", "‰", valueMax=1000, defaultValue=1000, checkbox=False):
-            if isinstance(widget, QLineEdit):
-                self.cleavingPwmNumber: QLineEdit = widget
+        cleavingDurationRow = make_labeled_slider_controls("UV", "ms", valueMax=5000, checkbox=False)
+        cleavingPwmRow = make_labeled_slider_controls("", "‰", valueMax=1000, defaultValue=1000, checkbox=False)
+        # Hold on to the sliders so we can retrieve their values on `cleave()`.
+        self.cleavingDurationSlider = cleavingDurationRow.slider
+        self.cleavingPwmSlider = cleavingPwmRow.slider
+        for widget in cleavingDurationRow.widgets() + cleavingPwmRow.widgets():
             uvCleavingControlsLayout.addWidget(widget)
         cleaveButton = QPushButton("Cleave")
         cleaveButton.clicked.connect(self.cleave)
@@ -302,67 +363,147 @@ class ManualControlsWidget(QWidget):
         # Lay them out.
         mainLayout = QVBoxLayout()
         mainLayout.addWidget(ledControlsWidget)
-        if overrideExposureWidget:
-            mainLayout.addWidget(overrideExposureWidget)
+        mainLayout.addWidget(self.overrideExposureWidget)
         mainLayout.addWidget(ledStartButtonsWidget)
         mainLayout.addWidget(livePreviewWidget)
-        if focusControlsWidget:
-            mainLayout.addWidget(focusControlsWidget)
-        if temperatureControlsWidget:
-            mainLayout.addWidget(temperatureControlsWidget)
+        mainLayout.addWidget(self.focusControlsWidget)
+        mainLayout.addWidget(self.temperatureControlsWidget)
         mainLayout.addWidget(uvCleavingControlsWidget)
         mainLayout.addWidget(self.stopButton)
 
         self.setLayout(mainLayout)
 
-        self.halThread.started.connect(partial(self.setStartButtonsEnabled, False))
-        self.halThread.finished.connect(partial(self.setStartButtonsEnabled, True))
+        for button in self.startButtons:
+            self.startButtonsEnabledChanged.connect(button.setEnabled)
+        for button in self.adjustmentsButtons:
+            self.adjustmentsButtonsEnabledChanged.connect(button.setEnabled)
+        self.halWorker.error.connect(self.showHalError)
+        self.halAdjustmentsWorker.error.connect(self.showHalError)
+        self.halWorker.busyChanged.connect(self.halBusyChanged)
         self.setStartButtonsEnabled(True)
+        self.halAdjustmentsWorker.busyChanged.connect(self.halAdjustmentsBusyChanged)
+
+        # `started` is emitted on the new thread before it processes any queued commands, so the HAL is always set up first.
+        self.halThread.started.connect(self.halWorker.connectToHal)
+        self.halAdjustmentsThread.started.connect(self.halAdjustmentsWorker.connectToHal)
+        self.halThread.start()
+        self.halAdjustmentsThread.start()
+        QCoreApplication.instance().aboutToQuit.connect(self.stopHalThreads)
+
+    @Slot(dict)
+    def setHalMetadata(self, halMetadata: Dict):
+        """Show the controls that the HAL supports."""
+        capabilities = HalCapabilities.from_metadata(halMetadata)
+        self.halCapabilities = capabilities
+        for widget in self.filterWidgets:
+            widget.setVisible(capabilities.filter_control)
+        self.overrideExposureWidget.setVisible(capabilities.can_override_exposure)
+        for widget in self.livePreviewExposureWidgets:
+            widget.setVisible(capabilities.can_override_exposure)
+        self.focusControlsWidget.setVisible(capabilities.focus_control)
+        self.temperatureControlsWidget.setVisible(capabilities.temperature_control)
+
+        maxLedFlashMs = capabilities.max_led_flash_ms
+        if maxLedFlashMs is not None:
+            for slider in self.durationSliders:
+                slider.setMaximum(maxLedFlashMs)
+            self.overrideExposureSlider.setMaximum(maxLedFlashMs)
+            # Defaults to the longest exposure.
+            self.overrideExposureSlider.setValue(maxLedFlashMs)
 
-        self.halAdjustmentsThread.started.connect(partial(self.setAdjustmentsButtonsEnabled, False))
-        self.halAdjustmentsThread.finished.connect(partial(self.setAdjustmentsButtonsEnabled, True))
-
+    @Slot(None)
+    def stopHalThreads(self):
+        for worker, thread in ((self.halWorker, self.halThread), (self.halAdjustmentsWorker, self.halAdjustmentsThread)):
+            worker.requestInterruption()
+            thread.quit()
+            thread.wait()
+
+    @Slot(str)
+    def showHalError(self, errorString: str):
+        # Only fetched once there's an error to show, as `qtHandler` also takes over all of Qt's warnings from then on.
+        QErrorMessage.qtHandler().showMessage(errorString)
+
+    @Slot(bool)
+    def halBusyChanged(self, busy: bool):
+        self.setStartButtonsEnabled(not busy)
+
+    @Slot(bool)
+    def halAdjustmentsBusyChanged(self, busy: bool):
+        self.setAdjustmentsButtonsEnabled(not busy)
+
+    @Slot(bool)
     def setStartButtonsEnabled(self, enabled: bool):
         self.stopButton.setEnabled(not enabled)
+        self.startButtonsEnabledChanged.emit(enabled)
 
-        for button in self.startButtons:
-            button.setEnabled(enabled)
-
+    @Slot(bool)
     def setAdjustmentsButtonsEnabled(self, enabled: bool):
-        for button in self.adjustmentsButtons:
-            button.setEnabled(enabled)
+        self.adjustmentsButtonsEnabledChanged.emit(enabled)
+
+    @Slot(str)
+    def filterChanged(self, text: str):
+        self.filterName = filter_name(text)
 
     @Slot(None)
-    def flash(self, flashMode: FlashMode):
-        overrideExposureTime: Optional[int] = None
-        if flashMode == FlashMode.CAPTURE_ONE and self.overrideExposureCheckbox and self.overrideExposureNumber and self.overrideExposureCheckbox.isChecked():
-            overrideExposureTime = int(self.overrideExposureNumber.text())
-        elif flashMode == FlashMode.LIVE_PREVIEW and self.livePreviewNumber:
-            overrideExposureTime = int(self.livePreviewNumber.text())
-        overrideExposureTimeMsArg = {
-            "exposure_time_ms_override": overrideExposureTime
-        } if overrideExposureTime is not None else {}
+    def flashOnly(self):
+        self.flash(FlashMode.FLASH_ONLY)
+
+    @Slot(None)
+    def captureOne(self):
+        self.flash(FlashMode.CAPTURE_ONE)
+
+    @Slot(None)
+    def startLivePreview(self):
+        self.flash(FlashMode.LIVE_PREVIEW)
+
+    @Slot(None)
+    def invalidateFlashes(self):
+        self.cachedFlashes = None
+
+    def makeFlashes(self, overrideExposureTime: Optional[int]) -> List[Dict]:
+        """
+        Describe the enabled LEDs' flashes for the HAL.
+        The result is reused until the LED controls change, so it must not be modified.
+        """
+        if self.cachedFlashes is not None and self.cachedFlashesOverride == overrideExposureTime:
+            return self.cachedFlashes
 
         flashes = []
-        for colorName, widget in self.durationNumbers.items():
-            duration_ms = int(widget.text())
+        for colorName in LED_COLORS:
+            duration_ms = self.durationValues[colorName]
             duration_ms = min(duration_ms, overrideExposureTime) if overrideExposureTime is not None else duration_ms
-            pwm = int(self.pwmNumbers[colorName].text())
-            if self.durationCheckboxes[colorName].isChecked() and duration_ms > 0:
+            pwm = self.pwmValues[colorName]
+            if self.durationEnabled[colorName] and duration_ms > 0:
                 flashes.append({
                     "led": colorName,
                     "duration_ms": duration_ms,
                     "intensity_per_mille": pwm
                 })
 
-        filter = self.filterPicker.currentText().lower().replace(" ", "_") if self.filterPicker else "any_filter"
+        self.cachedFlashes = flashes
+        self.cachedFlashesOverride = overrideExposureTime
+        return flashes
+
+    def flash(self, flashMode: FlashMode):
+        overrideExposureTime: Optional[int] = None
+        if self.halCapabilities.can_override_exposure and self.exposureOverrideEnabled.get(flashMode):
+            overrideExposureTime = self.exposureOverrides[flashMode]
+
+        flashes = self.makeFlashes(overrideExposureTime)
+
+        # Capturing or previewing without any LEDs is still useful (e.g. for a dark frame), but flashing isn't.
+        if flashMode == FlashMode.FLASH_ONLY and not flashes:
+            logger.info("No flashes configured, not flashing")
+            return
+
+        overrideExposureTimeMsArg = {
+            "exposure_time_ms_override": overrideExposureTime
+        } if overrideExposureTime is not None else {}
+        filter = self.filterName if self.halCapabilities.filter_control else "any_filter"
 
         # TODO: Request a larger preview (0.5x rather than 0.125x?)
         if flashMode == FlashMode.FLASH_ONLY:
-            if not flashes:
-                print("No flashes configured, not flashing")
-                return
-            self.halThread.runCommand({
+            self.halWorker.runCommand({
                 "command": "flash_leds",
                 "args": {
                     "flashes": flashes
@@ -370,14 +511,16 @@ class ManualControlsWidget(QWidget):
             })
         elif flashMode == FlashMode.CAPTURE_ONE:
             # Format the parameters that went into this capture into a filename-compatible string
-            labelDetails = json.dumps({"flashes": flashes, "filter": filter})
-            labelDetails = "".join([JSON_FILENAME_MAPPING.get(x, x) for x in labelDetails])
-            self.halThread.runCommand({
+            if self.cachedLabelDetails is not None and self.cachedLabelDetails[0] is flashes and self.cachedLabelDetails[1] == filter:
+                labelDetails = self.cachedLabelDetails[2]
+            else:
+                labelDetails = json.dumps({"flashes": flashes, "filter": filter}).translate(JSON_FILENAME_TRANSLATION)
+                self.cachedLabelDetails = (flashes, filter, labelDetails)
+            self.halWorker.runCommand({
                 "command": "run_image_sequence",
                 "args": {
                     "sequence": {
-                        "label": "Preview sequence",
-                        "schema_version": 0,
+                        **PREVIEW_SEQUENCE_TEMPLATE,
                         "images": [
                             {
                                 "label": labelDetails,
@@ -387,17 +530,16 @@ class ManualControlsWidget(QWidget):
                             }
                         ]
                     },
-                    "output_dir": str(MANUAL_OUTPUT_DIR),
+                    "output_dir": self.manualOutputDir,
                     **overrideExposureTimeMsArg
                 }
             })
         elif flashMode == FlashMode.LIVE_PREVIEW:
-            self.halThread.runCommand({
+            self.halWorker.runCommand({
                 "command": "run_live_preview",
                 "args": {
                     "sequence": {
-                        "label": "Preview sequence",
-                        "schema_version": 0,
+                        **PREVIEW_SEQUENCE_TEMPLATE,
                         "images": [
                             {
                                 "label": "Preview image",
@@ -410,20 +552,20 @@ class ManualControlsWidget(QWidget):
                 }
             })
         else:
-            print("Unknown flash mode, not flashing")
+            logger.info("Unknown flash mode, not flashing")
             return
 
     @Slot(None)
     def cleave(self):
-        cleavingDurationMs = int(self.cleavingDurationNumber.text())
-        cleavingPwm = int(self.cleavingPwmNumber.text())
+        cleavingDurationMs = self.cleavingDurationSlider.value()
+        cleavingPwm = self.cleavingPwmSlider.value()
 
         if not cleavingDurationMs or not cleavingPwm:
-            print("Cleaving duration == 0 or PWM == 0, not cleaving")
+            logger.info("Cleaving duration == 0 or PWM == 0, not cleaving")
             return
 
         # TODO: Request a larger preview (0.5x rather than 0.125x?)
-        self.halThread.runCommand({
+        self.halWorker.runCommand({
             "command": "cleave",
             "args": {
                 "cleave_args": {
@@ -439,12 +581,12 @@ class ManualControlsWidget(QWidget):
     def setTemperature(self):
         temperatureString = self.temperatureNumber.text()
         if not temperatureString:
-            print("Temperature not specified, not setting")
+            logger.info("Temperature not specified, not setting")
             return
 
         temperatureKelvin = float(temperatureString) + 273.15
 
-        self.halThread.runCommand({
+        self.halWorker.runCommand({
             "command": "wait_for_temperature",
             "args": {
                 "temperature_args": {
@@ -456,8 +598,11 @@ class ManualControlsWidget(QWidget):
         })
 
     @Slot(None)
+    def focusNudgeButtonClicked(self):
+        self.nudgeBaseFocus(self.sender().property("steps"))
+
     def nudgeBaseFocus(self, steps: int):
-        self.halAdjustmentsThread.runCommand({
+        self.halAdjustmentsWorker.runCommand({
             "command": "nudge_base_focus",
             "args": {
                 "nudge_base_focus_args": {
@@ -468,14 +613,14 @@ class ManualControlsWidget(QWidget):
 
     @Slot(None)
     def disableHeater(self):
-        self.halThread.runCommand({
+        self.halWorker.runCommand({
             "command": "disable_heater",
             "args": {}
         })
 
     @Slot(None)
     def resetFilterWheel(self):
-        self.halThread.runCommand({
+        self.halWorker.runCommand({
             "command": "reset_filter_wheel",
             "args": {}
         })
@@ -1,23 +1,45 @@
 import io
+import logging
 import math
 import socket
 import struct
 import time
-import traceback
 import sys
 from functools import partial
 from typing import Optional
 
 import numpy as np
 from PySide2.QtCore import Signal, Slot, QThread
-from PySide2.QtGui import QPixmap
+from PySide2.QtGui import QImage, QPixmap
 from PySide2.QtWidgets import QApplication, QGraphicsPixmapItem, QGraphicsScene, QGraphicsView, QHBoxLayout, QLabel, QSlider, QToolButton, QVBoxLayout, QWidget
 
-from pil_wrapper import Image, ImageQt
+import ip_utils
+from pil_wrapper import Image
+
+logger = logging.getLogger(__name__)
+
+# Each preview message starts with the size of the encoded image that follows.
+PREVIEW_SIZE_STRUCT = struct.Struct("I")  # 1 uint32_t
+# Enough for the HAL to send a whole image or two without waiting on us.
+# Linux caps this at /proc/sys/net/core/rmem_max, which may need raising for it to take full effect.
+PREVIEW_RECEIVE_BUFFER_SIZE = 8 << 20
 
 def align_ceil_32(unaligned: int):
     return math.ceil(unaligned / 32) * 32
 
+def recv_exactly(s: socket.socket, view: memoryview):
+    """Fill `view` from `s`."""
+    # `recv` returns whatever has arrived so far, which can be less than was asked for.
+    # Receive straight into the final buffer rather than copying each chunk onto the end of it.
+    size = len(view)
+    offset = 0
+    while offset < size:
+        chunk_size = s.recv_into(view[offset:])
+        if not chunk_size:
+            # Otherwise a closed connection would spin here forever.
+            raise ConnectionError("Preview socket closed")
+        offset += chunk_size
+
 class PreviewThread(QThread):
     received_image = Signal(Image.Image)
 
@@ -25,12 +47,22 @@ class PreviewThread(QThread):
         super().__init__()
         self.address = address
         self.port = port
+        # Reused for every message. The image buffer grows to fit the largest image so far.
+        self.size_buffer = bytearray(PREVIEW_SIZE_STRUCT.size)
+        self.image_buffer = bytearray()
 
     @Slot(None)
     def run(self):
+        # Probed here rather than by the caller so that a slow address doesn't hold up the GUI.
+        if not ip_utils.exists(self.address, self.port):
+            return
+
         while True:
             try:
                 with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+                    # Set before connecting, so that it can be taken into account for the TCP window.
+                    s.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, PREVIEW_RECEIVE_BUFFER_SIZE)
+                    logger.debug("Preview receive buffer is %d bytes", s.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF))
                     s.connect((self.address, self.port))
                     while True:
                         image = self.read_preview_image(s)
@@ -40,18 +72,21 @@ class PreviewThread(QThread):
                 break
             except:
                 # Something went wrong with the preview socket. Let me know and wait a bit before trying again.
-                traceback.print_exc()
+                logger.exception("Preview connection failed")
                 time.sleep(5)
 
     def read_preview_image(self, s: socket.socket) -> Image.Image:
-        image_size_bytes = s.recv(4)  # 1 uint32_t
-        (image_size,) = struct.unpack("I", image_size_bytes)
-
-        image_bytes = bytearray()
-        while len(image_bytes) < image_size:
-            image_bytes.extend(s.recv(image_size - len(image_bytes)))
-
-        return Image.open(io.BytesIO(image_bytes))
+        recv_exactly(s, memoryview(self.size_buffer))
+        (image_size,) = PREVIEW_SIZE_STRUCT.unpack(self.size_buffer)
+
+        if len(self.image_buffer) < image_size:
+            self.image_buffer = bytearray(image_size)
+        with memoryview(self.image_buffer) as image_view:
+            recv_exactly(s, image_view[:image_size])
+            image = Image.open(io.BytesIO(image_view[:image_size]))
+        # PIL only decodes the pixels when they're first used, which would otherwise be on the GUI thread in `drawImage`.
+        image.load()
+        return image
 
 class PreviewWidget(QWidget):
     DEFAULT_MIN_LEVEL = 0
@@ -64,7 +99,8 @@ class PreviewWidget(QWidget):
 
         self.graphicsScene = QGraphicsScene()
         self.graphicsView = QGraphicsView(self.graphicsScene)
-        self.lastGraphicsPixmapItem: Optional[QGraphicsPixmapItem] = None
+        # Each new image replaces the pixmap of the one item, rather than adding a new item to the scene.
+        self.graphicsPixmapItem: QGraphicsPixmapItem = self.graphicsScene.addPixmap(QPixmap())
 
         # Levels adjustment
         self.whiteLevelLabel = QLabel()
@@ -166,9 +202,11 @@ class PreviewWidget(QWidget):
 
         # The image will have to be converted to 8-bit for Qt as well.
         # No need to do it again though.
-        if self.lastGraphicsPixmapItem:
-            self.graphicsScene.removeItem(self.lastGraphicsPixmapItem)
-        self.lastGraphicsPixmapItem = self.graphicsScene.addPixmap(QPixmap.fromImage(ImageQt.ImageQt(image)))
+        # Wrap the 8-bit pixels directly instead of going through ImageQt, which copies them into a 32-bit aligned, indexed image first.
+        # The QImage doesn't own `imageBytes`, so it has to stay alive until `fromImage` has made the pixmap's copy.
+        imageBytes = image.tobytes()
+        qImage = QImage(imageBytes, image.width, image.height, image.width, QImage.Format_Grayscale8)
+        self.graphicsPixmapItem.setPixmap(QPixmap.fromImage(qImage))
 
 if __name__ == "__main__":
     app = QApplication()
@@ -5,6 +5,7 @@ from dataclasses import dataclass
 from pathlib import Path
 from typing import Callable, ClassVar, Dict, List, Optional, Tuple
 import json
+import logging
 import time
 
 import jsonschema
@@ -12,6 +13,8 @@ from PySide2.QtCore import QThread
 
 from hal import IHal, Hal, MockHal
 
+logger = logging.getLogger(__name__)
+
 @dataclass
 class RunContextNode:
     event: Event
@@ -84,11 +87,11 @@ class Event:
         if thread is not None and thread.isInterruptionRequested():
             raise InterruptedError
 
-        # TODO: Use a logging library
-        print(f">>> Running {type(self).__name__} step")
-        print(f"Line {self.protocol_line}, depth {self.protocol_depth}, path: {context}\nLabel: {self.label}")
-        print(f"Protocol path: {context}")
-        print(f"Time: {time.asctime(time.localtime(time.time()))}")
+        # Formatted lazily, as formatting the context isn't free and this runs for every event.
+        logger.info(">>> Running %s step", type(self).__name__)
+        logger.info("Line %s, depth %s, path: %s\nLabel: %s", self.protocol_line, self.protocol_depth, context, self.label)
+        logger.info("Protocol path: %s", context)
+        logger.info("Time: %s", time.asctime())
 
         # Notify the listener that we're running a new Event
         # The listener is only registered on the root Event
@@ -100,8 +103,17 @@ class Event:
         return 1
     
     def __iter__(self):
-        yield self
-    
+        # Pre-order walk of this event and its descendants.
+        # Uses an explicit stack rather than nesting a generator per level of the protocol.
+        stack: List[Event] = [self]
+        while stack:
+            event = stack.pop()
+            yield event
+            stack.extend(reversed(event.children()))
+
+    def children(self) -> List[Event]:
+        return []
+
     def gui_details(self, context: Optional[RunContext] = None) -> Optional[str]:
         return None
 
@@ -121,6 +133,9 @@ class ReactionCycle(Event):
 
             # Cleaving step
             # TODO: This is doing all of the work from Event.run(). Should this just be a dynamically generated Event instead?
+            # An interrupted HAL command returns without raising, so make sure we weren't stopped during the last child.
+            if context.thread is not None and context.thread.isInterruptionRequested():
+                raise InterruptedError
             context.path[-1].step_index = None
             callback = context.path[0].event.event_run_callback
             if callback is not None:
@@ -145,11 +160,8 @@ class ReactionCycle(Event):
     def __len__(self):
         return sum(map(len, self.events)) + 1
     
-    def __iter__(self):
-        yield self
-        for event in self.events:
-            for node in event:
-                yield node
+    def children(self) -> List[Event]:
+        return self.events
     
     def gui_details(self, context: Optional[RunContext] = None) -> str:
         cleave_duration_s = self.cleaving["cleaving_duration_ms"] / 1000
@@ -190,11 +202,8 @@ class Group(Event):
     def __len__(self):
         return sum(map(len, self.events)) + 1
     
-    def __iter__(self):
-        yield self
-        for event in self.events:
-            for node in event:
-                yield node
+    def children(self) -> List[Event]:
+        return self.events
     
     def gui_details(self, context: Optional[RunContext] = None) -> str:
         if context is None:
@@ -223,7 +232,10 @@ class ImageSequence(Event):
     def run(self, context: RunContext):
         super().run(context)
 
+        # Copy the images too, since we're about to fill in their filenames.
+        # The originals are shared with the protocol JSON that gets saved alongside each run.
         imaging_args = self.imaging_args.copy()
+        imaging_args["images"] = [image.copy() for image in imaging_args["images"]]
         for image in imaging_args["images"]:
             # The label is used as the wavelength.
             image["filename"] = f"{context.state.get_next_sequence_number():06}_$imageIndex_$imageLabel_C{context.state.cycle_number:04}_$timestamp_P-{context}.tif"
@@ -243,6 +255,9 @@ class ImageSequence(Event):
         images = self.imaging_args["images"]
         return f"{len(images)} images"
 
+# How often long-running events check whether they've been asked to stop.
+INTERRUPTION_POLL_PERIOD_MS = 100
+
 # TODO: Calculate a sane value for this using the temperature difference
 MAX_TEMPERATURE_WAIT_S = 20 * 60  # 20 minutes
 # TODO: Calculate a sane value for this using the estimated time remaining in the protocol
@@ -279,7 +294,7 @@ class Wait(Event):
 
     def run(self, context: RunContext):
         super().run(context)
-        print(f"Waiting {self.duration_ms} ms")
+        logger.info("Waiting %d ms", self.duration_ms)
 
         # If we're in a QThread, periodically check if we need to stop
         # TODO: There's probably a better way to do this
@@ -287,7 +302,7 @@ class Wait(Event):
         if thread is not None:
             remaining_duration = self.duration_ms
             while remaining_duration > 0:
-                duration = min(remaining_duration, 1000)
+                duration = min(remaining_duration, INTERRUPTION_POLL_PERIOD_MS)
                 thread.msleep(duration)
                 remaining_duration -= duration
                 if thread.isInterruptionRequested():
@@ -379,6 +394,7 @@ parser.add_argument("protocol", help="Path to the protocol file to run")
 parser.add_argument("output_directory", help="Where to save output files")
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     args = parser.parse_args()
 
     # Load the protocol
@@ -1,17 +1,19 @@
 import enum
 import json
+import logging
+import os
 import sys
 import time
 import traceback
 from datetime import datetime
-from functools import partial
+from functools import lru_cache, partial
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, Iterable, List, Optional, Tuple
 
-from PySide2.QtCore import Signal, Slot, QThread, QTimer
-from PySide2.QtGui import QTextBlock, QTextCursor, QTextBlockFormat, QTextCharFormat, QFont
+from PySide2.QtCore import Qt, Signal, Slot, QThread, QTimer
+from PySide2.QtGui import QTextCursor, QTextCharFormat, QFont
 from PySide2.QtNetwork import QTcpSocket
-from PySide2.QtWidgets import QMainWindow, QApplication, QWidget, QVBoxLayout, QHBoxLayout, QTextEdit, QPushButton, QAction, QFileDialog, QErrorMessage, QLabel, QSizePolicy
+from PySide2.QtWidgets import QMainWindow, QApplication, QWidget, QVBoxLayout, QHBoxLayout, QPlainTextEdit, QPushButton, QAction, QFileDialog, QErrorMessage, QLabel, QSizePolicy
 
 import ip_utils
 from hal import Hal, MockHal
@@ -21,9 +23,12 @@ from prompt_api import PromptApi
 from sequencing_protocol import load_protocol_json, validate_protocol_json, Event, RunContext, RunContextNode, RunState
 from version import VERSION
 
+logger = logging.getLogger(__name__)
+
 WINDOW_TITLE_BASE = "454 Sequencer"
 PROTOCOLS_DIR = "protocols"
-MARGIN_BETWEEN_EVENTS = 12
+INDENT_PER_DEPTH = "    "
+PROGRESS_UPDATE_INTERVAL_MS = 33
 
 HAL_PORT = 45400
 PREVIEW_PORT = 45401
@@ -45,15 +50,20 @@ class SequencingProtocolStatus(enum.Enum):
 class ProtocolThread(QThread):
     finished = Signal(SequencingProtocolStatus)
     error = Signal(tuple)
-    progress = Signal(RunContext)
+    # The context, along with the details text of each event on its path.
+    # `object` rather than `dict`, which PySide would convert to a QVariantMap and drop the int keys.
+    progress = Signal(RunContext, object)
 
     def __init__(self, halAddress):
         super().__init__()
         self.protocol: Optional[Event] = None
+        # Set once the HAL has reported it; saved alongside every run.
+        self.halMetadata: Optional[Dict] = None
 
         # Create the HAL iff there's a socket we can connect to.
         # Otherwise, run in mock mode.
-        if ip_utils.exists(halAddress, HAL_PORT):
+        # No short timeout, as a slow HAL would otherwise be replaced by a mock one.
+        if ip_utils.exists(halAddress, HAL_PORT, timeout=None):
             self.hal = Hal(halAddress, HAL_PORT)
         else:
             self.hal = MockHal()
@@ -72,7 +82,6 @@ class ProtocolThread(QThread):
                     json.dump(self.halMetadata, hal_metadata_file)
                 with open(output_dir / "protocol.454sp.json", mode="w") as protocol_file:
                     json.dump(self.protocolJson, protocol_file)
-                # TODO: Set up logging
                 self.hal.reset_filter_wheel(self)
                 protocol.run(RunContext([RunContextNode(protocol)], output_dir, self.hal, RunState(), self))
             except Exception as e:
@@ -89,33 +98,124 @@ class ProtocolThread(QThread):
                 self.finished.emit(result)
 
     def eventRunCallback(self, context: RunContext):
-        self.progress.emit(context)
+        # Format the details here so the GUI thread only has to lay them out.
+        details: Dict[int, Optional[str]] = {}
+        for node in context.path:
+            event = node.event
+            try:
+                details[event.protocol_line] = event.gui_details(context)
+            except ValueError:
+                # Groups and cycles can't describe their progress until their first child starts.
+                details[event.protocol_line] = None
+        self.progress.emit(context, details)
+
+class ProtocolLoaderThread(QThread):
+    # Path, raw protocol JSON, root event, and all events in protocol line order.
+    loaded = Signal(str, dict, Event, list)
+    error = Signal(tuple)
 
-class ProtocolViewer(QTextEdit):
+    def __init__(self):
+        super().__init__()
+        self.path: Optional[str] = None
+        # Protocols are often reopened between runs, so keep what we've already parsed (keyed by path and mtime).
+        self.cache: Dict[Tuple[str, float], Tuple[Dict, Event, List[Event]]] = {}
+
+    @Slot(None)
+    def run(self):
+        path = self.path
+        if path is None:
+            return
+
+        try:
+            key = (path, os.path.getmtime(path))
+            cached = self.cache.get(key)
+            if cached is not None:
+                protocol_json, protocol, events = cached
+            else:
+                with open(path) as protocol_file:
+                    protocol_json = json.load(protocol_file)
+                validate_protocol_json(protocol_json)
+                protocol, _ = load_protocol_json(protocol_json)
+                # Walk the tree once; index `protocol_line` corresponds to the event on that line.
+                events = list(protocol)
+                self.cache[key] = (protocol_json, protocol, events)
+        except Exception as e:
+            self.error.emit((type(e), e, ""))
+            return
+
+        self.loaded.emit(path, protocol_json, protocol, events)
+
+class HalMetadataThread(QThread):
+    loaded = Signal(dict)
+    error = Signal(tuple)
+
+    def __init__(self, hal):
+        super().__init__()
+        self.hal = hal
+
+    @Slot(None)
+    def run(self):
+        try:
+            halMetadata = self.hal.run_command({
+                "command": "get_metadata",
+                "args": {}
+            })
+        except Exception as e:
+            self.error.emit((type(e), e, ""))
+            return
+
+        self.loaded.emit(halMetadata)
+
+def flatten_protocol(events: Iterable[Event]) -> Tuple[List[int], List[str], List[str]]:
+    """Produce the depth, header text, and details text of each line of the protocol."""
+    depths: List[int] = []
+    headers: List[str] = []
+    details: List[str] = []
+    for event in events:
+        depths.append(event.protocol_depth)
+        headers.append(f"({event.readable_type}) {event.label}")
+        details.append(event.gui_details() or "")
+    return depths, headers, details
+
+class ProtocolViewer(QPlainTextEdit):
     def __init__(self):
         super().__init__()
         self.setReadOnly(True)
         self.setMinimumSize(600, 300)
+        # Nothing here is user-editable, so don't keep an undo history of every progress update.
+        self.setUndoRedoEnabled(False)
+        self.setContextMenuPolicy(Qt.NoContextMenu)
 
-        self.eventTextBlocks: List[Tuple[QTextBlock, Optional[QTextBlock]]] = []
+        # Block numbers of each event's header and details lines.
+        self.eventBlockNumbers: List[Tuple[int, int]] = []
+        self.eventIndentLengths: List[int] = []
         self.lastContext: Optional[RunContext] = None
+        self.lastContextDetails: Dict[int, Optional[str]] = {}
+        # Details and elapsed seconds as last written to the document, by protocol line.
+        self.lastDetails: Dict[int, Tuple[str, int]] = {}
+        # Reused by `formatLine` rather than creating a new cursor for every line.
+        self.formatCursor = QTextCursor(self.document())
 
         self.reformatTimer = QTimer(self)
         self.reformatTimer.setInterval(1000)
         self.reformatTimer.timeout.connect(self.reformatLastContext)
 
-    @staticmethod
-    def makeBlockFormats(depth: int) -> Tuple[QTextBlockFormat, QTextBlockFormat]:
-        eventFormat = QTextBlockFormat()
-        eventFormat.setTopMargin(MARGIN_BETWEEN_EVENTS)
-        eventFormat.setIndent(depth)
-
-        detailsFormat = QTextBlockFormat()
-        detailsFormat.setIndent(depth)
+        # Fast protocols can report progress much faster than we can usefully redraw.
+        # Only keep the most recent context and redraw once per interval.
+        self.pendingContext: Optional[RunContext] = None
+        self.pendingContextDetails: Dict[int, Optional[str]] = {}
+        self.progressTimer = QTimer(self)
+        self.progressTimer.setSingleShot(True)
+        self.progressTimer.setInterval(PROGRESS_UPDATE_INTERVAL_MS)
+        self.progressTimer.timeout.connect(self.flushProgress)
 
-        return eventFormat, detailsFormat
+    @staticmethod
+    def makeIndent(depth: int) -> str:
+        # QPlainTextEdit's layout ignores block indents and margins, so the nesting is spelled out in the text instead.
+        return INDENT_PER_DEPTH * depth
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def makeCharFormats(active: bool = False, on_path: bool = False) -> Tuple[QTextCharFormat, QTextCharFormat]:
         eventFormat = QTextCharFormat()
         if active:
@@ -125,49 +225,57 @@ class ProtocolViewer(QTextEdit):
 
         detailsFormat = QTextCharFormat()
 
+        # These are cached and shared between callers, so they must not be modified.
         return eventFormat, detailsFormat
 
-    def loadProtocol(self, protocol: Event):
-        cursor = QTextCursor(self.document())
-        self.eventTextBlocks = []
-        for event in protocol:
-            eventBlockFormat, detailsBlockFormat = self.makeBlockFormats(event.protocol_depth)
-            eventCharFormat, detailsCharFormat = self.makeCharFormats()
-
-            cursor.insertBlock(eventBlockFormat)
-            cursor.setCharFormat(eventCharFormat)
-            cursor.insertText(f"({event.readable_type}) {event.label}")
-            eventBlock = cursor.block()
-
-            detailsBlock: Optional[QTextBlock] = None
-            details = event.gui_details()
-            cursor.insertBlock(detailsBlockFormat)
-            cursor.setCharFormat(detailsCharFormat)
-            if details:
-                cursor.insertText(details)
-            detailsBlock = cursor.block()
-
-            self.eventTextBlocks.append((eventBlock, detailsBlock))
-
-    def formatLine(self, context: RunContext, active):
+    def loadProtocol(self, events: List[Event]):
+        """Display a protocol, given its events in protocol line order (`list(protocol)`)."""
+        depths, headers, details = flatten_protocol(events)
+
+        # Each event takes up three lines: a blank separator (QPlainTextEdit has no block margins), the header, and the details.
+        # Building the text up front and setting it in one go is much faster than inserting it block by block.
+        lines: List[str] = []
+        for depth, header, eventDetails in zip(depths, headers, details):
+            indent = self.makeIndent(depth)
+            lines.append("")
+            lines.append(f"{indent}{header}")
+            lines.append(f"{indent}{eventDetails}")
+        self.setPlainText("\n".join(lines))
+
+        # Hold on to where each event ended up, so `formatLine` doesn't have to work it out again.
+        self.eventBlockNumbers = [(3 * line + 1, 3 * line + 2) for line in range(len(depths))]
+        self.eventIndentLengths = [len(self.makeIndent(depth)) for depth in depths]
+        self.lastDetails = {}
+
+    def formatLine(self, context: RunContext, details: Dict[int, Optional[str]], active):
+        pathCharFormats = self.makeCharFormats(False, on_path=active)
+        activeCharFormats = self.makeCharFormats(active, on_path=active)
+        lastNodeIndex = len(context.path) - 1
+        document = self.document()
         for node_index, node in enumerate(context.path):
             event = node.event
-            node_active = active and (node_index == len(context.path) - 1)
-            lines = self.eventTextBlocks[event.protocol_line]
-
-            blockFormats = self.makeBlockFormats(event.protocol_depth)
-            charFormats = self.makeCharFormats(node_active, on_path=active)
-            for line_index, (line, blockFormat, charFormat) in enumerate(zip(lines, blockFormats, charFormats)):
+            lines = map(document.findBlockByNumber, self.eventBlockNumbers[event.protocol_line])
+            indentLength = self.eventIndentLengths[event.protocol_line]
+            charFormats = activeCharFormats if node_index == lastNodeIndex else pathCharFormats
+            for line_index, (line, charFormat) in enumerate(zip(lines, charFormats)):
                 newText: Optional[str] = None
-                if line_index == 1:
+                eventDetails = details.get(event.protocol_line)
+                if line_index == 1 and eventDetails is not None:
                     # Details line may change to indicate things like what iteration is running.
-                    mins, secs = divmod(int(time.time() - node.start_time), 60)
-                    newText = f"{mins}:{secs:02}: {event.gui_details(context)}"
-
-                cursor = QTextCursor(line)
-                cursor.movePosition(QTextCursor.EndOfLine, QTextCursor.KeepAnchor)
+                    elapsedSecs = int(time.time() - node.start_time)
+                    # Avoid rewriting lines whose details and elapsed time haven't changed since the last update.
+                    # Checked before formatting, as the text includes the elapsed time.
+                    lineDetails = (eventDetails, elapsedSecs)
+                    if lineDetails != self.lastDetails.get(event.protocol_line):
+                        self.lastDetails[event.protocol_line] = lineDetails
+                        mins, secs = divmod(elapsedSecs, 60)
+                        newText = f"{mins}:{secs:02}: {eventDetails}"
+
+                # Leave the indent alone so it isn't underlined along with the text.
+                cursor = self.formatCursor
+                cursor.setPosition(line.position() + indentLength)
+                cursor.movePosition(QTextCursor.EndOfBlock, QTextCursor.KeepAnchor)
                 cursor.setCharFormat(charFormat)
-                cursor.setBlockFormat(blockFormat)
                 if newText:
                     cursor.insertText(newText)
 
@@ -175,32 +283,46 @@ class ProtocolViewer(QTextEdit):
     @Slot(None)
     def reformatLastContext(self):
         if self.lastContext is not None:
-            self.formatLine(self.lastContext, active=True)
+            self.formatLine(self.lastContext, self.lastContextDetails, active=True)
+
+    @Slot(RunContext, object)
+    def progress(self, context: RunContext, details: Dict[int, Optional[str]]):
+        self.pendingContext = context
+        self.pendingContextDetails = details
+        if not self.progressTimer.isActive():
+            self.progressTimer.start()
+
+    @Slot(None)
+    def flushProgress(self):
+        context = self.pendingContext
+        if context is None:
+            return
+        details = self.pendingContextDetails
+        self.pendingContext = None
 
-    @Slot(RunContext)
-    def progress(self, context: RunContext):
         if self.lastContext is not None:
-            self.formatLine(self.lastContext, active=False)
+            self.formatLine(self.lastContext, self.lastContextDetails, active=False)
 
-        self.formatLine(context, active=True)
+        self.formatLine(context, details, active=True)
         self.lastContext = context
+        self.lastContextDetails = details
 
 class SequencingUi(QMainWindow):
     def __init__(self, halAddress):
         super().__init__()
 
         self.protocolThread = ProtocolThread(halAddress)
-        halMetadata = self.protocolThread.hal.run_command({
-            "command": "get_metadata",
-            "args": {}
-        })
 
-        self.populateWidgets(halAddress, halMetadata)
+        self.populateWidgets(halAddress)
 
         self.protocolThread.progress.connect(self.protocolViewer.progress)
         self.protocolThread.finished.connect(self.finished)
         self.protocolThread.error.connect(self.error)
 
+        self.protocolLoaderThread = ProtocolLoaderThread()
+        self.protocolLoaderThread.loaded.connect(self.protocolLoaded)
+        self.protocolLoaderThread.error.connect(self.protocolLoadFailed)
+
         self.setWindowTitle(WINDOW_TITLE_BASE)
 
         # Holder for dynamic status bar widgets (placed on the left)
@@ -212,20 +334,22 @@ class SequencingUi(QMainWindow):
             self.connectToStatusServer(halAddress)
 
         # Holder for static status bar widgets (placed on the right)
-        statusBarText = [f"GUI v{VERSION}"]
-        statusBarText.append(f"Unit {halMetadata['serial_number'][-8:]}")
-        statusBarText.append(f"HAL v{halMetadata['hal_version']}")
-        for text in statusBarText:
-            self.statusBar().addPermanentWidget(QLabel(text))
-        self.protocolThread.halMetadata = halMetadata
+        self.statusBar().addPermanentWidget(QLabel(f"GUI v{VERSION}"))
 
         self.stop()
         self.startButton.setEnabled(False)
+
+        # Don't hold up the window while waiting for the HAL; the rest of the status bar and the manual controls are filled in once it responds.
+        # Shares the protocol thread's HAL, which is only safe because runs can't start until the metadata has arrived.
+        self.halMetadataThread = HalMetadataThread(self.protocolThread.hal)
+        self.halMetadataThread.loaded.connect(self.halMetadataLoaded)
+        self.halMetadataThread.error.connect(self.error)
+        self.halMetadataThread.start()
     
-    def populateWidgets(self, halAddress, halMetadata):
+    def populateWidgets(self, halAddress):
         self.previewWidget = PreviewWidget()
-        if ip_utils.exists(halAddress, PREVIEW_PORT):
-            self.previewWidget.connectToHal(halAddress, PREVIEW_PORT)
+        # Does nothing if there's no preview server to connect to.
+        self.previewWidget.connectToHal(halAddress, PREVIEW_PORT)
 
         # Create the main elements...
         self.protocolViewer = ProtocolViewer()
@@ -234,7 +358,7 @@ class SequencingUi(QMainWindow):
         toggleManualButton = QPushButton("Manual controls")
         # TODO: Make this hook into the the ProtocolThread's HAL instead (or vice versa)
         # TODO: This avoids unnecessary threads and allows a protocol event to disable the manual buttons
-        self.manualControls = ManualControlsWidget(halAddress, halMetadata)
+        self.manualControls = ManualControlsWidget(halAddress)
         self.openAction = QAction("&Open")
         # self.settingsAction = QAction("S&ettings")
 
@@ -345,39 +469,60 @@ class SequencingUi(QMainWindow):
             # Dialog closed
             return
         
-        try:
-            with open(path) as protocol_file:
-                protocol_json = json.load(protocol_file)
-                validate_protocol_json(protocol_json)
-                self.protocol, _ = load_protocol_json(protocol_json)
-        except Exception as e:
-            self.error((type(e), e, ""))
-            return
+        # Large protocols take a while to parse and validate, so do that in the background.
+        self.openAction.setEnabled(False)
+        self.startButton.setEnabled(False)
+        self.protocolLoaderThread.path = path
+        self.protocolLoaderThread.start()
+
+    @Slot(dict)
+    def halMetadataLoaded(self, halMetadata: Dict):
+        self.statusBar().addPermanentWidget(QLabel(f"Unit {halMetadata['serial_number'][-8:]}"))
+        self.statusBar().addPermanentWidget(QLabel(f"HAL v{halMetadata['hal_version']}"))
+        self.manualControls.setHalMetadata(halMetadata)
+        self.protocolThread.halMetadata = halMetadata
+        # A protocol may have been opened while we were waiting.
+        self.startButton.setEnabled(self.protocolThread.protocol is not None and not self.protocolLoaderThread.isRunning())
+
+    @Slot(tuple)
+    def protocolLoadFailed(self, error: Tuple):
+        self.error(error)
+        self.openAction.setEnabled(True)
+        # The previously opened protocol (if any) is still loaded.
+        self.startButton.setEnabled(self.protocolThread.protocol is not None and self.protocolThread.halMetadata is not None)
+
+    @Slot(str, dict, Event, list)
+    def protocolLoaded(self, path: str, protocol_json: Dict, protocol: Event, events: List[Event]):
+        self.protocol = protocol
+        self.protocolEvents = events
 
         self.protocolViewer.clear()
-        self.protocolViewer.loadProtocol(self.protocol)
+        self.protocolViewer.loadProtocol(self.protocolEvents)
         self.protocolThread.protocol = self.protocol
         # Hold on to the raw protocol so we can save it in the output_dir for each run.
         self.protocolThread.protocolJson = protocol_json
 
-        self.startButton.setEnabled(True)
+        self.openAction.setEnabled(True)
+        # Runs can't start until we have the HAL's metadata to save with them.
+        self.startButton.setEnabled(self.protocolThread.halMetadata is not None)
         self.setWindowTitle(f"{Path(path).name} - {WINDOW_TITLE_BASE}")
 
         self.updateStatusWidget("status", SequencingProtocolStatus.READY.value)
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     app = QApplication(sys.argv)
     halAddress = ip_utils.CONNECT_ADDRESS if len(sys.argv) == 1 else sys.argv[1]
     ui = SequencingUi(halAddress)
     ui.show()
 
-    if ip_utils.exists(halAddress, HAL_PORT):
+    if ip_utils.exists(halAddress, HAL_PORT, timeout=None):
         # Only need the prompt API if we're connecting to a HAL.
         promptApi = PromptApi(ui)
         promptApi.received_image.connect(ui.previewWidget.showImage)
     else:
         # Otherwise, we're in mock mode. Make it obvious.
-        print(MOCK_WARNING_TEXT)
+        logger.warning(MOCK_WARNING_TEXT)
         QErrorMessage.qtHandler().showMessage(MOCK_WARNING_TEXT)
 
     sys.exit(app.exec_())